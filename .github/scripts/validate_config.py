@@ -9,20 +9,30 @@ Environment variables
 ---------------------
 LLM_API_KEY       : (required) API key for LLM
 UPSTREAM_VERSION    : (optional) git tag to fetch config from; defaults to 'main'
+UPSTREAM_CACHE_DIR  : (optional) where fetched upstream configs and ETags are kept;
+                      defaults to ~/.cache/picoclaw-upstream
+HTTPS_PROXY         : (optional) proxy to send all requests through
 GITHUB_OUTPUT       : (set by Actions) path to write step outputs
 """
 
 from __future__ import annotations
 
 import ast
+import hashlib
 import json
 import os
+import random
 import re
 import sys
-import textwrap
 import time
-import urllib.error
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+try:
+    import orjson
+except ImportError:  # optional; not installed on the Actions runner by default
+    orjson = None
 
 # ---------------------------------------------------------------------------
 # Constants
@@ -32,17 +42,49 @@ API_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL = "minimax/minimax-m2.5"
 
 MAX_RETRIES = 3
-INITIAL_BACKOFF_S = 5       # 5 → 15 → 45
+INITIAL_BACKOFF_S = 5       # 5 → 15 → 45, each ±50% jitter
 BACKOFF_MULTIPLIER = 3
 REQUEST_TIMEOUT_S = 120
+MIN_MAX_TOKENS = 4096
+MAX_TOKENS = 65536
+# Reasoning models spend part of max_tokens on hidden thinking before any output.
+REASONING_HEADROOM_TOKENS = 8192
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504, 529})
+MAX_REDIRECTS = 5
+HTTP_TIMEOUT = urllib3.Timeout(connect=10, read=REQUEST_TIMEOUT_S)
 
 UPSTREAM_CONFIG_URL_TPL = (
     "https://raw.githubusercontent.com/sipeed/picoclaw/{ref}/config/config.example.json"
 )
 
+UPSTREAM_CACHE_DIR = os.environ.get("UPSTREAM_CACHE_DIR") or os.path.join(
+    os.path.expanduser("~"), ".cache", "picoclaw-upstream"
+)
+
 REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
 SERVER_PY = os.path.join(REPO_ROOT, "server.py")
 INDEX_HTML = os.path.join(REPO_ROOT, "templates", "index.html")
+DEFAULT_CONFIG_TEMPLATE = "_DEFAULT_CONFIG_TEMPLATE"  # default config literal in server.py
+
+_RE_JSON_FENCE = re.compile(r"```(?:json)?\s*([\s\S]*?)```")
+# Groups: 1=<script> open, 2=</script> close, 3=x-data, 4=x-model, 5=defaultConfig
+_RE_HTML_CHECK = re.compile(
+    r"(?i:(<script[\s>])|(</script>))|(x-data=)|(x-model=)|(defaultConfig\(\)|function defaultConfig)"
+)
+PY_REQUIRED_MARKERS = ("default_config", "SECRET_FIELDS", "Route")
+_RE_PY_MARKERS = re.compile("|".join(PY_REQUIRED_MARKERS))
+# DOCTYPE at the start, after an optional BOM, whitespace and <!-- comments -->
+_RE_DOCTYPE = re.compile(r"\ufeff?(?:\s|<!--.*?-->)*<!doctype html>", re.IGNORECASE | re.DOTALL)
+_RE_CHANGES_NEEDED = re.compile(r'"changes_needed"\s*:\s*(true|false)')
+# A 400 body complaining about the structured content-parts form of the prompt.
+_RE_CONTENT_FORMAT_ERROR = re.compile(
+    r"cache_control|content.{0,40}\b(?:type|format|array|list|parts?|string)\b"
+    r"|\b(?:type|format|array|list|parts?|string)\b.{0,40}content",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Returned by call_llm when the stream is abandoned after a "no changes" verdict.
+NO_CHANGES_RESPONSE = '{"changes_needed": false}'
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -61,16 +103,124 @@ def set_output(name: str, value: str) -> None:
             f.write(f"{name}={value}\n")
 
 
-def fetch_url(url: str, timeout: int = 30) -> str:
-    """Fetch a URL and return the body as text."""
-    req = urllib.request.Request(url)
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        return resp.read().decode("utf-8")
+def dumps_indented(obj: object) -> str:
+    """Serialize to 2-space indented JSON, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+    return json.dumps(obj, indent=2)
+
+
+class HTTPStatusError(Exception):
+    """Raised when a request completes with a non-2xx status."""
+
+    def __init__(self, status: int, headers: urllib3.HTTPHeaderDict, body: bytes):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+def _pool_manager() -> urllib3.PoolManager:
+    """Build the shared pool, going through HTTPS_PROXY when it is set."""
+    # urllib3 only follows redirects here; call_llm does its own retrying.
+    retries = urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=MAX_REDIRECTS)
+    proxy = os.environ.get("HTTPS_PROXY") or os.environ.get("https_proxy")
+    if proxy:
+        auth = urllib3.util.parse_url(proxy).auth
+        return urllib3.ProxyManager(
+            proxy,
+            proxy_headers=urllib3.make_headers(proxy_basic_auth=auth) if auth else None,
+            retries=retries,
+            timeout=HTTP_TIMEOUT,
+        )
+    return urllib3.PoolManager(retries=retries, timeout=HTTP_TIMEOUT)
+
+
+# One pool for the whole run, so retries and repeat hosts reuse connections.
+_HTTP = _pool_manager()
+
+
+def http_request(
+    method: str,
+    url: str,
+    body: bytes | None = None,
+    headers: dict[str, str] | None = None,
+    timeout: float | urllib3.Timeout = HTTP_TIMEOUT,
+    stream: bool = False,
+) -> urllib3.BaseHTTPResponse:
+    """Send a request through the shared pool and return the response.
+
+    With ``stream=True`` the body is left unread and the caller must release
+    the connection. Non-2xx responses are read and raised as HTTPStatusError.
+    """
+    resp = _HTTP.request(
+        method, url, body=body, headers=headers, timeout=timeout, preload_content=not stream
+    )
+    if not 200 <= resp.status < 300:
+        data = resp.data
+        resp.release_conn()
+        raise HTTPStatusError(resp.status, resp.headers, data)
+    return resp
+
+
+def _cache_paths(url: str) -> tuple[str, str]:
+    """Return the (body, etag) cache file paths for a URL."""
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+    base = os.path.join(UPSTREAM_CACHE_DIR, key)
+    return f"{base}.body", f"{base}.etag"
+
+
+def fetch_url(url: str, immutable: bool = False, timeout: int = 30) -> str:
+    """Fetch a URL and return the body as text.
+
+    Responses are kept in UPSTREAM_CACHE_DIR. An ``immutable`` URL (one pinned
+    to a release tag) is served from there without a request once cached.
+    Other URLs are revalidated with If-None-Match, reusing the cached body on
+    304 Not Modified.
+    """
+    body_path, etag_path = _cache_paths(url)
+    headers: dict[str, str] = {}
+    if immutable:
+        if os.path.exists(body_path):
+            log("Using cached upstream config")
+            return read_file(body_path)
+    else:
+        try:
+            with open(etag_path, "r", encoding="utf-8") as f:
+                etag = f.read().strip()
+            if etag and os.path.exists(body_path):
+                headers["If-None-Match"] = etag
+        except OSError:
+            pass
+
+    try:
+        resp = http_request("GET", url, headers=headers, timeout=timeout)
+    except HTTPStatusError as e:
+        if e.status == 304 and headers:
+            log("Upstream config not modified; using cached copy")
+            return read_file(body_path)
+        raise
+
+    data = resp.data
+    etag = None if immutable else resp.headers.get("ETag")
+    if immutable or etag:
+        try:
+            os.makedirs(UPSTREAM_CACHE_DIR, exist_ok=True)
+            if os.path.exists(etag_path):
+                os.remove(etag_path)  # never pair a stale ETag with a new body
+            with open(body_path, "wb") as f:
+                f.write(data)
+            if etag:
+                write_file(etag_path, etag)
+        except OSError as e:
+            log(f"WARNING: Could not cache upstream config: {e}")
+    return data.decode("utf-8")
 
 
 def read_file(path: str) -> str:
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
+    # Binary read + one decode; skips text-mode newline translation
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8")
 
 
 def write_file(path: str, content: str) -> None:
@@ -83,63 +233,86 @@ def write_file(path: str, content: str) -> None:
 # ---------------------------------------------------------------------------
 
 
-def _flatten(obj: object, prefix: str = "") -> dict[str, object]:
+def _flatten(obj: object) -> dict[str, object]:
     """Flatten a nested dict to dot-separated paths."""
     items: dict[str, object] = {}
-    if isinstance(obj, dict):
-        for k, v in obj.items():
-            new_key = f"{prefix}.{k}" if prefix else k
-            items.update(_flatten(v, new_key))
-    elif isinstance(obj, list):
-        items[prefix] = obj
-    else:
-        items[prefix] = obj
+    stack: list[tuple[str, object]] = [("", obj)]
+    while stack:
+        prefix, value = stack.pop()
+        if isinstance(value, dict):
+            # Reversed so paths come out in document order
+            for k, v in reversed(value.items()):
+                stack.append((f"{prefix}.{k}" if prefix else k, v))
+        else:
+            items[prefix] = value
     return items
 
 
 def get_config_analysis(upstream: dict, current_defaults: dict) -> dict:
     """Analyze configuration differences for LLM context."""
-    flat_upstream = _flatten(upstream)
-    flat_current = _flatten(current_defaults)
-    
-    upstream_keys = set(flat_upstream.keys())
-    current_keys = set(flat_current.keys())
-    
-    new_keys = upstream_keys - current_keys
-    
+    if upstream == current_defaults:
+        # Identical trees: one flatten is enough and there is nothing new
+        keys = list(_flatten(upstream))
+        return {
+            "upstream_config": upstream,
+            "known_fields": keys,
+            "upstream_keys": keys,
+            "new_keys": []
+        }
+
+    upstream_keys = _flatten(upstream).keys()
+    current_keys = _flatten(current_defaults).keys()
+
     return {
         "upstream_config": upstream,
         "known_fields": list(current_keys),
         "upstream_keys": list(upstream_keys),
-        "new_keys": list(new_keys)
+        "new_keys": list(upstream_keys - current_keys)
     }
 
 
 def extract_json_from_response(response: str) -> dict | None:
     """Extract and parse JSON from LLM response (handling markdown blocks)."""
     try:
-        # Extract JSON from response (handle potential markdown code blocks)
-        json_match = re.search(r'```(?:json)?\s*([\s\S]*?)```', response)
-        if json_match:
-            json_str = json_match.group(1).strip()
-        else:
-            json_str = response.strip()
+        json_str = response.strip()
+        # A bare JSON document needs no fence scan (and any ``` inside it
+        # belongs to embedded file content, not to a markdown block)
+        if not json_str.startswith("{"):
+            # Extract JSON from response (handle potential markdown code blocks)
+            json_match = _RE_JSON_FENCE.search(json_str)
+            if json_match:
+                json_str = json_match.group(1).strip()
         return json.loads(json_str)
     except Exception:
         return None
 
 
 def extract_default_config_json(server_src: str) -> dict | None:
-    """Try to extract the dict returned by default_config() in server.py."""
+    """Try to extract the default config dict literal from server.py.
+
+    Looks for the module-level _DEFAULT_CONFIG_TEMPLATE assignment, falling
+    back to a dict literal returned directly by default_config().
+    """
     try:
         tree = ast.parse(server_src)
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef) and node.name == "default_config":
-                for stmt in node.body:
-                    if isinstance(stmt, ast.Return) and stmt.value:
-                        # ast.literal_eval can evaluate a Dict node if it contains only literals
-                        assert stmt.value is not None
-                        return ast.literal_eval(stmt.value)
+        # Both forms live at module level; no need to walk every node
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(
+                isinstance(t, ast.Name) and t.id == DEFAULT_CONFIG_TEMPLATE for t in node.targets
+            ):
+                value = node.value
+            elif isinstance(node, ast.FunctionDef) and node.name == "default_config":
+                value = next(
+                    (stmt.value for stmt in node.body if isinstance(stmt, ast.Return) and stmt.value),
+                    None,
+                )
+                if not isinstance(value, ast.Dict):
+                    continue
+            else:
+                continue
+            # ast.literal_eval already yields plain dicts/lists for a literal
+            val = ast.literal_eval(value)
+            return val if isinstance(val, dict) else None
         return None
     except Exception:
         return None
@@ -149,40 +322,40 @@ def extract_default_config_json(server_src: str) -> dict | None:
 # LLM interaction
 # ---------------------------------------------------------------------------
 
-SYSTEM_PROMPT = textwrap.dedent("""\
-    You are an expert Python and JavaScript/HTML developer specializing in web configuration interfaces.
-
-    Your task is to analyze the upstream PicoClaw configuration schema and determine if the web management console (server.py and index.html) needs updates to expose new or changed configuration options.
-
-    RESPONSE FORMAT (JSON only, no other text):
-    {
-      "changes_needed": true/false,
-      "server_py_changes": {
-        "needed": true/false,
-        "description": "Description of changes needed",
-        "modified_code": "full modified server.py content if needed, null otherwise"
-      },
-      "index_html_changes": {
-        "needed": true/false,
-        "description": "Description of changes needed", 
-        "modified_code": "full modified index.html content if needed, null otherwise"
-      },
-      "new_config_options": ["list of new config options detected"],
-      "removed_config_options": ["list of removed/deprecated config options"],
-      "summary": "Brief summary of changes"
-    }
-
-    GUIDELINES:
-    1. Only suggest changes if NEW configuration options exist in upstream that aren't exposed in the web UI
-    2. Maintain the existing code style and structure
-    3. Ensure Alpine.js bindings are correct in HTML
-    4. Preserve all existing functionality
-    5. Use appropriate input types (password for secrets, checkbox for booleans, etc.)
-    6. Group related settings logically
-    7. DO NOT remove existing configuration options even if not in upstream
-    8. The server.py default_config() function should include defaults for new options
-    9. SECRET_FIELDS set should include any new secret fields
-""")
+SYSTEM_PROMPT = """\
+You are an expert Python and JavaScript/HTML developer specializing in web configuration interfaces.
+
+Your task is to analyze the upstream PicoClaw configuration schema and determine if the web management console (server.py and index.html) needs updates to expose new or changed configuration options.
+
+RESPONSE FORMAT (JSON only, no other text):
+{
+  "changes_needed": true/false,
+  "server_py_changes": {
+    "needed": true/false,
+    "description": "Description of changes needed",
+    "modified_code": "full modified server.py content if needed, null otherwise"
+  },
+  "index_html_changes": {
+    "needed": true/false,
+    "description": "Description of changes needed", 
+    "modified_code": "full modified index.html content if needed, null otherwise"
+  },
+  "new_config_options": ["list of new config options detected"],
+  "removed_config_options": ["list of removed/deprecated config options"],
+  "summary": "Brief summary of changes"
+}
+
+GUIDELINES:
+1. Only suggest changes if NEW configuration options exist in upstream that aren't exposed in the web UI
+2. Maintain the existing code style and structure
+3. Ensure Alpine.js bindings are correct in HTML
+4. Preserve all existing functionality
+5. Use appropriate input types (password for secrets, checkbox for booleans, etc.)
+6. Group related settings logically
+7. DO NOT remove existing configuration options even if not in upstream
+8. The _DEFAULT_CONFIG_TEMPLATE dict in server.py (returned by default_config()) should include defaults for new options
+9. SECRET_FIELDS set should include any new secret fields
+"""
 
 
 
@@ -190,87 +363,209 @@ def generate_llm_prompt(
     analysis: dict,
     server_src: str,
     index_src: str,
-) -> str:
-    return textwrap.dedent(f"""\
-        Analyze the PicoClaw configuration files for necessary updates.
+) -> list[dict]:
+    """Build the user message as content parts.
+
+    The large, retry-invariant context (upstream schema and both files) goes
+    first and is marked cacheable so providers that support prompt caching
+    can reuse it across attempts; the short analysis summary follows.
+    """
+    static_context = f"""\
+Analyze the PicoClaw configuration files for necessary updates.
+
+## Upstream Configuration Schema
+```json
+{dumps_indented(analysis['upstream_config'])}
+```
+
+## Current server.py
+```python
+{server_src}
+```
+
+## Current templates/index.html
+```html
+{index_src}
+```
 
-        ## Upstream Configuration Schema
-        ```json
-        {json.dumps(analysis['upstream_config'], indent=2)}
-        ```
+"""
+    dynamic_tail = f"""\
+## Analysis Summary
+- Known fields in current implementation: {sorted(analysis['known_fields'])}
+- Fields in upstream config: {sorted(analysis['upstream_keys'])}
+- Potentially new fields: {sorted(analysis['new_keys'])}
 
-        ## Current server.py
-        ```python
-        {server_src}
-        ```
+Determine if updates are needed to expose any new configuration options in the web management console. Return ONLY valid JSON.
+"""
+    return [
+        {"type": "text", "text": static_context, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": dynamic_tail},
+    ]
 
-        ## Current templates/index.html
-        ```html
-        {index_src}
-        ```
 
-        ## Analysis Summary
-        - Known fields in current implementation: {sorted(analysis['known_fields'])}
-        - Fields in upstream config: {sorted(analysis['upstream_keys'])}
-        - Potentially new fields: {sorted(analysis['new_keys'])}
+def flatten_prompt(parts: list[dict]) -> str:
+    """Join content parts into the plain-string form every provider accepts."""
+    return "".join(part["text"] for part in parts)
 
-        Determine if updates are needed to expose any new configuration options in the web management console. Return ONLY valid JSON.
-    """)
 
+def _jittered(backoff: float) -> float:
+    """Spread retries of concurrent runners over ±50% of the nominal backoff."""
+    return backoff * random.uniform(0.5, 1.5)
 
-def call_llm(api_key: str, system: str, user: str) -> str:
-    """Call the LLM chat completions API with retry and backoff."""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-    }
-    payload = json.dumps({
+
+def max_tokens_for(server_src: str, index_src: str) -> int:
+    """Size the completion budget to the files the model may have to rewrite."""
+    estimate = (len(server_src) + len(index_src)) // 3 + 2048 + REASONING_HEADROOM_TOKENS
+    return min(MAX_TOKENS, max(MIN_MAX_TOKENS, estimate))
+
+
+class CompletionTruncated(RuntimeError):
+    """Raised when the completion stopped because it ran out of max_tokens."""
+
+
+def _read_stream(resp: urllib3.BaseHTTPResponse) -> str:
+    """Assemble the content deltas of a streamed (SSE) chat completion.
+
+    Stops reading as soon as the model answers "changes_needed": false, since
+    nothing after that verdict is used. Raises CompletionTruncated if the
+    model hit max_tokens, as retrying with the same budget would not help.
+    """
+    pieces: list[str] = []
+    head = ""  # leading text, inspected until the verdict is known
+    decided = False
+    finish_reason = None
+
+    try:
+        for raw in resp:
+            line = raw.strip()
+            if not line.startswith(b"data:"):
+                continue  # blank separators and ": keep-alive" comments
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+
+            chunk = json.loads(data)
+            if chunk.get("error"):
+                raise ValueError(f"Stream error: {chunk['error']}")
+            choices = chunk.get("choices")
+            if not choices:
+                continue  # e.g. a trailing usage-only chunk
+            choice = choices[0]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            delta = (choice.get("delta") or {}).get("content")
+            if not delta:
+                continue
+            pieces.append(delta)
+
+            if not decided:
+                head += delta
+                m = _RE_CHANGES_NEEDED.search(head)
+                if m:
+                    decided = True
+                    if m.group(1) == "false":
+                        resp.close()  # abandon the rest; the connection is not reused
+                        return NO_CHANGES_RESPONSE
+                elif len(head) > 4096:
+                    decided = True
+        resp.read()
+    except Exception:
+        resp.close()
+        raise
+    finally:
+        resp.release_conn()
+
+    if finish_reason == "length":
+        log(f"Completion truncated at max_tokens ({sum(map(len, pieces))} chars received)")
+        raise CompletionTruncated("Completion truncated (finish_reason=length)")
+    if not pieces:
+        raise ValueError("Empty completion")
+    return "".join(pieces)
+
+
+def _build_payload(system: str, user: str | list[dict], max_tokens: int) -> bytes:
+    return json.dumps({
         "model": MODEL,
         "messages": [
             {"role": "system", "content": system},
             {"role": "user", "content": user},
         ],
+        "max_tokens": max_tokens,
+        "stream": True,
     }).encode("utf-8")
 
+
+def call_llm(
+    api_key: str,
+    system: str,
+    user: str | list[dict],
+    max_tokens: int = MAX_TOKENS,
+) -> str:
+    """Call the LLM chat completions API with retry and backoff.
+
+    ``user`` may be a list of content parts; if the provider rejects that form
+    (an HTTP 400 about the content format), the request is re-sent once with the
+    parts joined into a string. That fallback does not use up a retry.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+        "Authorization": f"Bearer {api_key}",
+    }
+    payload = _build_payload(system, user, max_tokens)
+
     backoff = INITIAL_BACKOFF_S
 
-    for attempt in range(1, MAX_RETRIES + 1):
+    attempt = 1
+    while attempt <= MAX_RETRIES:
         try:
-            log(f"LLM request attempt {attempt}/{MAX_RETRIES} …")
-            req = urllib.request.Request(API_URL, data=payload, headers=headers, method="POST")
-            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT_S) as resp:
-                body = json.loads(resp.read().decode("utf-8"))
-                content = body["choices"][0]["message"]["content"]
-                log(f"LLM responded ({len(content)} chars)")
-                return content
-
-        except urllib.error.HTTPError as e:
-            status = e.code
+            log(f"LLM request attempt {attempt}/{MAX_RETRIES} (max_tokens={max_tokens}) …")
+            resp = http_request("POST", API_URL, body=payload, headers=headers, stream=True)
+            content = _read_stream(resp)
+            log(f"LLM responded ({len(content)} chars)")
+            return content
+
+        except HTTPStatusError as e:
+            status = e.status
             log(f"HTTP {status} from API")
 
-            if status == 429:
-                retry_after = e.headers.get("Retry-After")
-                wait = int(retry_after) if retry_after and retry_after.isdigit() else backoff
-                log(f"Rate limited. Waiting {wait}s …")
-                time.sleep(wait)
-            elif 500 <= status < 600:
-                log(f"Server error. Waiting {backoff}s …")
-                time.sleep(backoff)
-            else:
-                # 4xx (non-429) — not retryable
-                body = e.read().decode("utf-8", errors="replace")
+            body = e.body.decode("utf-8", errors="replace")
+            if (
+                status == 400
+                and isinstance(user, list)
+                and _RE_CONTENT_FORMAT_ERROR.search(body)
+            ):
+                log("Structured prompt rejected; retrying with a plain-text prompt …")
+                user = flatten_prompt(user)
+                payload = _build_payload(system, user, max_tokens)
+                continue
+
+            if status not in RETRYABLE_STATUS:
                 log(f"Non-retryable error: {body}")
                 raise
 
-        except (urllib.error.URLError, TimeoutError, OSError) as e:
-            log(f"Network error: {e}. Waiting {backoff}s …")
-            time.sleep(backoff)
+            retry_after = e.headers.get("Retry-After") if status == 429 else None
+            if retry_after and retry_after.isdigit():
+                wait = float(retry_after)
+            else:
+                wait = _jittered(backoff)
+            if status == 429:
+                log(f"Rate limited. Waiting {wait:.1f}s …")
+            else:
+                log(f"Server error. Waiting {wait:.1f}s …")
+            time.sleep(wait)
+
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            wait = _jittered(backoff)
+            log(f"Network error: {e}. Waiting {wait:.1f}s …")
+            time.sleep(wait)
 
-        except (json.JSONDecodeError, KeyError, IndexError) as e:
-            log(f"Malformed response: {e}. Waiting {backoff}s …")
-            time.sleep(backoff)
+        except (ValueError, KeyError, IndexError) as e:
+            wait = _jittered(backoff)
+            log(f"Malformed response: {e}. Waiting {wait:.1f}s …")
+            time.sleep(wait)
 
         backoff *= BACKOFF_MULTIPLIER
+        attempt += 1
 
     raise RuntimeError("LLM request failed after all retries")
 
@@ -287,14 +582,15 @@ def validate_python(src: str) -> list[str]:
     """Validate that the Python source is syntactically correct and contains key markers."""
     errors: list[str] = []
     try:
-        ast.parse(src)
+        # Byte-compiling checks syntax without materialising Python AST objects
+        compile(src, SERVER_PY, "exec", dont_inherit=True)
     except SyntaxError as e:
         errors.append(f"Python syntax error: {e}")
         return errors  # No point checking further
 
-    required_markers = ["default_config", "SECRET_FIELDS", "Route"]
-    for marker in required_markers:
-        if marker not in src:
+    found = {m.group(0) for m in _RE_PY_MARKERS.finditer(src)}
+    for marker in PY_REQUIRED_MARKERS:
+        if marker not in found:
             errors.append(f"Missing expected identifier: {marker}")
 
     return errors
@@ -304,23 +600,27 @@ def validate_html(src: str) -> list[str]:
     """Basic validation for the HTML template."""
     errors: list[str] = []
 
-    if "<!DOCTYPE html>" not in src and "<!doctype html>" not in src.lower():
+    if not _RE_DOCTYPE.match(src):
         errors.append("Missing <!DOCTYPE html>")
 
+    # One pass over the document, counting each pattern by its group
+    counts = [0] * 6
+    for m in _RE_HTML_CHECK.finditer(src):
+        counts[m.lastindex] += 1
+    opens, closes, x_data, x_model, default_config = counts[1:]
+
     # Check balanced <script>…</script>
-    opens = len(re.findall(r"<script[\s>]", src, re.IGNORECASE))
-    closes = len(re.findall(r"</script>", src, re.IGNORECASE))
     if opens != closes:
         errors.append(f"Unbalanced <script> tags: {opens} opens vs {closes} closes")
 
     # Must still have Alpine.js patterns
-    if "x-data=" not in src:
+    if not x_data:
         errors.append("Missing Alpine.js x-data binding")
-    if "x-model=" not in src:
+    if not x_model:
         errors.append("Missing Alpine.js x-model binding")
 
     # Must still have defaultConfig function
-    if "defaultConfig()" not in src and "function defaultConfig" not in src:
+    if not default_config:
         errors.append("Missing defaultConfig() function")
 
     return errors
@@ -340,37 +640,40 @@ def main() -> int:
     upstream_ref = os.environ.get("UPSTREAM_VERSION", "main").strip() or "main"
     config_url = UPSTREAM_CONFIG_URL_TPL.format(ref=upstream_ref)
 
-    # --- Fetch upstream config ------------------------------------------
+    # --- Fetch upstream config while reading current files ---------------
     log(f"Fetching upstream config from {config_url}")
-    try:
-        upstream_json_str = fetch_url(config_url)
-        upstream_config = json.loads(upstream_json_str)
-    except Exception as e:
-        log(f"WARNING: Could not fetch upstream config: {e}")
-        log("Falling back to main branch …")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Anything but main is a release tag, whose content never changes.
+        upstream_future = executor.submit(fetch_url, config_url, upstream_ref != "main")
+
+        log("Reading current server.py and index.html")
         try:
-            config_url = UPSTREAM_CONFIG_URL_TPL.format(ref="main")
-            upstream_json_str = fetch_url(config_url)
-            upstream_config = json.loads(upstream_json_str)
-        except Exception as e2:
-            log(f"ERROR: Could not fetch upstream config from main either: {e2}")
-            set_output("config_changed", "false")
-            set_output("files_updated", "false")
-            return 0  # fail-open
+            server_src = read_file(SERVER_PY)
+            index_src = read_file(INDEX_HTML)
+        except FileNotFoundError as e:
+            log(f"ERROR: {e}")
+            return 1
 
-    # --- Read current files ---------------------------------------------
-    log("Reading current server.py and index.html")
-    try:
-        server_src = read_file(SERVER_PY)
-        index_src = read_file(INDEX_HTML)
-    except FileNotFoundError as e:
-        log(f"ERROR: {e}")
-        return 1
+        try:
+            upstream_json_str = upstream_future.result()
+            upstream_config = json.loads(upstream_json_str)
+        except Exception as e:
+            log(f"WARNING: Could not fetch upstream config: {e}")
+            log("Falling back to main branch …")
+            try:
+                config_url = UPSTREAM_CONFIG_URL_TPL.format(ref="main")
+                upstream_json_str = fetch_url(config_url)
+                upstream_config = json.loads(upstream_json_str)
+            except Exception as e2:
+                log(f"ERROR: Could not fetch upstream config from main either: {e2}")
+                set_output("config_changed", "false")
+                set_output("files_updated", "false")
+                return 0  # fail-open
 
     # --- Analysis -------------------------------------------------------
     current_config = extract_default_config_json(server_src)
     if current_config is None:
-        log("WARNING: Could not extract default_config() from server.py; sending full context to LLM")
+        log("WARNING: Could not extract the default config from server.py; sending full context to LLM")
         # Ensure we have a valid structure even if current defaults extraction fails
         analysis = {
             "upstream_config": upstream_config,
@@ -393,7 +696,9 @@ def main() -> int:
     user_prompt = generate_llm_prompt(analysis, server_src, index_src)
 
     try:
-        response = call_llm(api_key, SYSTEM_PROMPT, user_prompt)
+        response = call_llm(
+            api_key, SYSTEM_PROMPT, user_prompt, max_tokens_for(server_src, index_src)
+        )
     except Exception as e:
         log(f"ERROR: LLM call failed: {e}")
         with open("latest_llm_error.txt", "w", encoding="utf-8") as f:
@@ -404,6 +709,12 @@ def main() -> int:
         return 0
 
     # --- Parse Response -------------------------------------------------
+    if response == NO_CHANGES_RESPONSE:
+        # Stream was cut short on a "no changes" verdict; nothing to parse
+        log("LLM determined no changes are needed")
+        set_output("files_updated", "false")
+        return 0
+
     result = extract_json_from_response(response)
     if not result:
         log("ERROR: Could not parse LLM response as JSON")
@@ -424,8 +735,9 @@ def main() -> int:
     server_changes = result.get("server_py_changes", {})
     if server_changes.get("needed") and server_changes.get("modified_code"):
         new_server = server_changes["modified_code"]
-        py_errors = validate_python(new_server)
-        if not py_errors:
+        if new_server == server_src:
+            log("Suggested server.py is identical to the current file; not rewriting")
+        elif not (py_errors := validate_python(new_server)):
             write_file(SERVER_PY, new_server)
             log(f"Updated server.py: {server_changes.get('description')}")
             files_modified = True
@@ -438,8 +750,9 @@ def main() -> int:
     html_changes = result.get("index_html_changes", {})
     if html_changes.get("needed") and html_changes.get("modified_code"):
         new_index = html_changes["modified_code"]
-        html_errors = validate_html(new_index)
-        if not html_errors:
+        if new_index == index_src:
+            log("Suggested index.html is identical to the current file; not rewriting")
+        elif not (html_errors := validate_html(new_index)):
             write_file(INDEX_HTML, new_index)
             log(f"Updated index.html: {html_changes.get('description')}")
             files_modified = True
@@ -465,4 +778,7 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    try:
+        sys.exit(main())
+    finally:
+        _HTTP.clear()